@@ -1,28 +1,55 @@
 import streamlit as st
 from main import SQLGenerator
-import time
+import pandas as pd
 from dotenv import load_dotenv
 import os
+from collections import deque
+from itertools import islice
 from datetime import datetime, timezone
 
 # Load environment variables
 load_dotenv()
 
-def initialize_sql_generator():
-    """Initialize SQL Generator with progress bar"""
-    progress_text = "Initializing components..."
-    my_bar = st.progress(0, text=progress_text)
+# Maximum number of past queries kept per session, and how many are shown
+QUERY_HISTORY_SIZE = 50
+QUERY_HISTORY_SHOWN = 5
+
+# Sample questions offered in the sidebar
+EXAMPLE_QUESTIONS = [
+    "How many copies of 'To Kill a Mockingbird' do we have?",
+    "What are the Fantasy books we have in our inventory?",
+    "Show me the total stock value for books by J.K. Rowling",
+    "What are the Books We have by Agatha Christie",
+    "What is the average price of books by genre?",
+    "List all books with stock quantity less than 100"
+]
+
+# Pixel sizes used to fit the results table to its rows, up to a fixed cap
+DATAFRAME_ROW_HEIGHT = 35
+DATAFRAME_HEADER_HEIGHT = 38
+DATAFRAME_MAX_HEIGHT = 600
+
+# Bounds on cached CSV downloads kept in memory across sessions
+CSV_CACHE_MAX_ENTRIES = 32
+CSV_CACHE_TTL = 3600
+
+def initialize_sql_generator(api_key):
+    """Initialize SQL Generator with a progress bar updated once per stage"""
+    my_bar = st.progress(0, text="Loading embeddings...")
 
     try:
-        api_key = os.getenv('OPENAI_API_KEY')
         if not api_key:
             raise ValueError("OpenAI API key not found in environment variables")
 
-        for percent_complete in range(100):
-            time.sleep(0.01)
-            my_bar.progress(percent_complete + 1, text=progress_text)
+        embeddings = SQLGenerator._load_embeddings()
+
+        my_bar.progress(30, text="Embedding few-shot examples...")
+        example_matrix = SQLGenerator._build_example_matrix(embeddings)
 
-        sql_generator = SQLGenerator(api_key)
+        my_bar.progress(70, text="Preparing SQL generator...")
+        sql_generator = SQLGenerator(api_key, example_matrix=example_matrix)
+
+        my_bar.progress(100, text="Ready")
         my_bar.empty()
         return sql_generator
 
@@ -30,6 +57,133 @@ def initialize_sql_generator():
         my_bar.empty()
         raise e
 
+@st.cache_resource(show_spinner=False)
+def get_sql_generator(api_key: str) -> SQLGenerator:
+    """Build the SQL Generator once per process and share it across sessions"""
+    return initialize_sql_generator(api_key)
+
+@st.cache_data(max_entries=CSV_CACHE_MAX_ENTRIES, ttl=CSV_CACHE_TTL, show_spinner=False)
+def _df_to_csv(df: pd.DataFrame) -> bytes:
+    """Serialize query results to CSV bytes, cached on the DataFrame contents"""
+    return df.to_csv(index=False).encode("utf-8")
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _current_minute_utc() -> str:
+    """Current UTC time to the minute for the sidebar, refreshed at most once a minute"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+def _csv_file_name(sql_query):
+    """Download file name, stamped when a query's results are first shown in this
+    session and kept in session state so it stays stable across reruns"""
+    stamped_query, file_name = st.session_state.get('csv_file_name', (None, None))
+    if stamped_query != sql_query:
+        file_name = f"query_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        st.session_state['csv_file_name'] = (sql_query, file_name)
+    return file_name
+
+def add_to_query_history(question, sql_query):
+    """Record a question and its SQL once, evicting the oldest entry when full.
+    Returns True if a new entry was added."""
+    history = st.session_state.query_history
+    seen = st.session_state.query_questions
+    if question in seen:
+        return False
+
+    if len(history) == history.maxlen:
+        seen.discard(history[0][0])
+    history.append((question, sql_query))
+    seen.add(question)
+    return True
+
+def apply_example_pick():
+    """Copy the picked example into the question box and reset the picker so it can be picked again"""
+    picked = st.session_state.example_pick
+    if picked:
+        st.session_state.question_input = picked
+        st.session_state.example_pick = ""
+
+@st.fragment
+def query_panel(sql_generator):
+    """Render the question input and query results, rerunning on its own when the question changes"""
+    question = st.text_input(
+        "Enter your question about book inventory:",
+        placeholder="e.g., How many copies of 'To Kill a Mockingbird' do we have?",
+        key="question_input"
+    )
+
+    if not question:
+        return
+
+    # SQL handed over by the full rerun below, so it is not generated twice
+    sql_query = st.session_state.pop('rerun_sql', {}).get(question)
+
+    if sql_query is None:
+        stream_slot = st.empty()
+        try:
+            with st.spinner("🤔 Generating SQL query..."):
+                # Generate SQL query, showing the response as it streams in
+                sql_query = sql_generator.generate_sql(
+                    question,
+                    on_token=lambda text: stream_slot.code(text, language="sql")
+                )
+                stream_slot.empty()
+        except Exception as e:
+            stream_slot.empty()
+            st.error(f"❌ Error: {str(e)}")
+            return
+
+        # The history panel is a separate fragment, so rerun the whole app to
+        # show a new entry, passing the generated SQL along in session state
+        if add_to_query_history(question, sql_query):
+            st.session_state['rerun_sql'] = {question: sql_query}
+            st.rerun()
+
+    try:
+        with st.spinner("🤔 Fetching results..."):
+            # Display generated SQL
+            st.subheader("Generated SQL Query")
+            with st.expander("View SQL Query", expanded=True):
+                st.code(sql_query, language="sql")
+
+            # Execute query and display results
+            st.subheader("Query Results")
+            df = sql_generator.execute_sql_query(sql_query)
+
+            if df is not None and not df.empty:
+                st.dataframe(
+                    df,
+                    use_container_width=True,
+                    height=min(DATAFRAME_ROW_HEIGHT * len(df) + DATAFRAME_HEADER_HEIGHT, DATAFRAME_MAX_HEIGHT)
+                )
+
+                # Add download button
+                csv = _df_to_csv(df)
+                st.download_button(
+                    label="📥 Download Results as CSV",
+                    data=csv,
+                    file_name=_csv_file_name(sql_query),
+                    mime="text/csv",
+                    key="download_button"
+                )
+            else:
+                st.warning("⚠️ No results found for this query.")
+
+    except Exception as e:
+        st.error(f"❌ Error: {str(e)}")
+
+@st.fragment
+def history_panel():
+    """Render the most recent queries, rerunning independently of the main panel"""
+    with st.expander("📚 Query History", expanded=True):
+        if st.session_state.query_history:
+            recent = islice(reversed(st.session_state.query_history), QUERY_HISTORY_SHOWN)
+            for i, (q, sql) in enumerate(recent):
+                st.markdown(f"**Q{i + 1}:** {q}")
+                st.code(sql, language="sql")
+                st.markdown("---")
+        else:
+            st.write("No queries yet. Start by asking a question!")
+
 def main():
     st.set_page_config(
         page_title="Book Inventory Query System",
@@ -41,14 +195,15 @@ def main():
     if 'sql_generator' not in st.session_state:
         try:
             with st.spinner('Initializing components...'):
-                st.session_state.sql_generator = initialize_sql_generator()
+                st.session_state.sql_generator = get_sql_generator(os.getenv('OPENAI_API_KEY'))
             st.success("✅ System initialized successfully!")
         except Exception as e:
             st.error(f"Error initializing application: {str(e)}")
             st.stop()
 
-    if 'question' not in st.session_state:
-        st.session_state['question'] = ""
+    if 'query_history' not in st.session_state:
+        st.session_state.query_history = deque(maxlen=QUERY_HISTORY_SIZE)
+        st.session_state.query_questions = set()
 
     # App UI
     st.title("Book Inventory Query System")
@@ -57,8 +212,7 @@ def main():
     with st.sidebar:
         st.markdown("---")
         st.markdown(f"**Current User:** RealChAuLa")
-        current_time = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
-        st.markdown(f"**Last Updated:** {current_time}")
+        st.markdown(f"**Last Updated:** {_current_minute_utc()}")
         st.markdown("---")
 
         st.header("About")
@@ -68,62 +222,20 @@ def main():
         """)
 
         st.header("Example Questions")
-        example_questions = [
-            "How many copies of 'To Kill a Mockingbird' do we have?",
-            "What are the Fantasy books we have in our inventory?",
-            "Show me the total stock value for books by J.K. Rowling",
-            "What are the Books We have by Agatha Christie",
-            "What is the average price of books by genre?",
-            "List all books with stock quantity less than 100"
-        ]
-
-        for q in example_questions:
-            if st.button(q, key=f"btn_{q}"):
-                st.session_state['question'] = q
+        st.selectbox(
+            "Example questions",
+            [""] + EXAMPLE_QUESTIONS,
+            index=0,
+            key="example_pick",
+            on_change=apply_example_pick,
+            label_visibility="collapsed"
+        )
 
     # Main content area
     col1, col2 = st.columns([2, 1])
 
     with col1:
-        question = st.text_input(
-            "Enter your question about book inventory:",
-            value=st.session_state.get('question', ''),
-            placeholder="e.g., How many copies of 'To Kill a Mockingbird' do we have?",
-            key="question_input"
-        )
-
-        if question:
-            try:
-                with st.spinner("🤔 Generating SQL query and fetching results..."):
-                    # Generate SQL query
-                    sql_query = st.session_state.sql_generator.generate_sql(question)
-
-                    # Display generated SQL
-                    st.subheader("Generated SQL Query")
-                    with st.expander("View SQL Query", expanded=True):
-                        st.code(sql_query, language="sql")
-
-                    # Execute query and display results
-                    st.subheader("Query Results")
-                    df = st.session_state.sql_generator.execute_sql_query(sql_query)
-
-                    if df is not None and not df.empty:
-                        st.dataframe(df, use_container_width=True)
-
-                        # Add download button
-                        csv = df.to_csv(index=False)
-                        st.download_button(
-                            label="📥 Download Results as CSV",
-                            data=csv,
-                            file_name=f"query_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                            mime="text/csv",
-                            key="download_button"
-                        )
-                    else:
-                        st.warning("⚠️ No results found for this query.")
-
-            except Exception as e:
-                st.error(f"❌ Error: {str(e)}")
+        query_panel(st.session_state.sql_generator)
 
     with col2:
         # Help section
@@ -150,20 +262,7 @@ def main():
             """)
 
         # Query History
-        if 'query_history' not in st.session_state:
-            st.session_state.query_history = []
-
-        with st.expander("📚 Query History", expanded=True):
-            if question and question not in [h[0] for h in st.session_state.query_history]:
-                st.session_state.query_history.append((question, sql_query))
-
-            if st.session_state.query_history:
-                for i, (q, sql) in enumerate(reversed(st.session_state.query_history[-5:])):
-                    st.markdown(f"**Q{i + 1}:** {q}")
-                    st.code(sql, language="sql")
-                    st.markdown("---")
-            else:
-                st.write("No queries yet. Start by asking a question!")
+        history_panel()
 
     # Footer
     st.markdown("---")
@@ -1,11 +1,15 @@
 import openai
-from langchain.prompts import PromptTemplate, FewShotPromptTemplate
-from langchain.chains import LLMChain
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import FAISS
-from langchain.prompts.example_selector import SemanticSimilarityExampleSelector
-import mysql.connector
-from mysql.connector import Error
+import streamlit as st
+import hashlib
+import re
+import threading
+import time
+import uuid
+import warnings
+from collections import OrderedDict, deque
+import numpy as np
+import sqlglot
+from sqlglot import exp
 import pandas as pd
 from few_shots import few_shots
 import os
@@ -14,6 +18,131 @@ from dotenv import load_dotenv
 # Load environment variables from the .env file
 load_dotenv()
 
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+
+# On-disk int8 ONNX export of the embedding model
+EMBEDDING_MODEL_DIR = "./.cache/onnx_minilm_int8"
+
+# Texts per forward pass; covers all few-shot examples in a single pass
+EMBEDDING_BATCH_SIZE = 16
+
+# On-disk embedding matrix of the few-shot examples, keyed on the embedding
+# model and their content so edits to either invalidate it automatically
+FEW_SHOTS_HASH = hashlib.sha256(repr((EMBEDDING_MODEL_NAME, few_shots)).encode()).hexdigest()[:8]
+FEW_SHOTS_MATRIX_PATH = f"./.cache/fewshots_int8_{FEW_SHOTS_HASH}.npy"
+
+# Number of pooled MySQL connections kept open per process
+POOL_SIZE = 5
+
+# Instructions placed ahead of the few-shot examples in every prompt, kept
+# terse since every prompt token adds to OpenAI prefill time and cost
+PREFIX = "books(book_id,title,author_id,genre,price,stock_quantity). Write one SQL:"
+
+# Upper bound on prompt tokens, excluding the user's question
+PROMPT_TOKEN_BUDGET = 200
+
+# Label noise the model sometimes echoes around the query
+_RESPONSE_NOISE_RE = re.compile(r"SQL Query:(?:\[/INST\])?")
+
+# First line of the response containing a SELECT statement
+_SELECT_RE = re.compile(r"(?m)^.*\bSELECT\b.*$")
+
+# Quoted strings and numbers in a question; a semantic cache hit requires
+# these to match exactly, since they barely move the embedding
+_LITERAL_RE = re.compile(r"(?<!\w)'[^']*'|\"[^\"]*\"|\d+(?:\.\d+)?")
+
+# Tables generated queries are allowed to read from
+ALLOWED_TABLES = {"books", "authors", "orders"}
+
+
+@st.cache_resource(show_spinner=False)
+def load_embedding_model(model_name=EMBEDDING_MODEL_NAME):
+    """
+    Load the int8-quantized ONNX embedding model once per process.
+    Shared across sessions and SQLGenerator instances, so a different API key
+    does not trigger a model reload.
+    """
+    # Imported here so importing this module does not pull in onnxruntime/transformers
+    from onnx_embeddings import QuantizedOnnxEmbeddings
+
+    return QuantizedOnnxEmbeddings(model_name, EMBEDDING_MODEL_DIR, batch_size=EMBEDDING_BATCH_SIZE)
+
+
+def format_prompt(examples, question):
+    """
+    Build the compact few-shot prompt for a question.
+    """
+    shots = "\n".join(f"Q:{e['Question']}\nA:{e['SQLQuery']}" for e in examples)
+    return f"{PREFIX}\n{shots}\nQ:{question}\nA:"
+
+
+def check_prompt_budget(num_examples):
+    """
+    Ensure the prompt with the longest few-shot examples stays within PROMPT_TOKEN_BUDGET.
+    Development check, run with `python main.py` after editing PREFIX or few_shots.py;
+    tiktoken downloads its BPE tables on first use, so this stays off the app's startup path.
+    """
+    import tiktoken
+
+    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    longest = sorted(few_shots, key=lambda e: len(e['Question']) + len(e['SQLQuery']))[-num_examples:]
+    num_tokens = len(encoding.encode(format_prompt(longest, "")))
+    if num_tokens >= PROMPT_TOKEN_BUDGET:
+        raise Exception(f"Prompt uses {num_tokens} tokens, budget is {PROMPT_TOKEN_BUDGET}")
+    return num_tokens
+
+
+def validate_sql(query):
+    """
+    Parse a generated query and return it normalized for MySQL.
+    - Rejects anything that does not parse or is not a single SELECT statement.
+    - Rejects references to tables outside ALLOWED_TABLES or outside the configured database.
+    """
+    try:
+        parsed = sqlglot.parse_one(query, dialect="mysql")
+    except sqlglot.errors.SqlglotError as e:
+        raise Exception(f"Invalid SQL: {e}")
+
+    if not isinstance(parsed, exp.Select):
+        raise Exception("Only SELECT queries are allowed")
+
+    database = SQLGenerator.DB_CONFIG["database"].lower()
+    cte_names = {cte.alias_or_name.lower() for cte in parsed.find_all(exp.CTE)}
+    for table in parsed.find_all(exp.Table):
+        if table.catalog or (table.db and table.db.lower() != database):
+            raise Exception(f"Query references a table outside the {database} database: {table.sql(dialect='mysql')}")
+        name = table.name.lower()
+        if name not in ALLOWED_TABLES and name not in cte_names:
+            raise Exception(f"Query references unknown table: {table.name}")
+
+    return parsed.sql(dialect="mysql")
+
+
+def _stream_openai(prompt_text, on_token=None):
+    """
+    Stream a completion for a fully formatted prompt from GPT-3.5-turbo.
+    - Calls on_token with the text received so far after every chunk.
+    - Stops before the model starts inventing another few-shot question.
+    Returns the complete response text.
+    """
+    parts = []
+    for chunk in openai.ChatCompletion.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt_text}
+        ],
+        stop=["\nQ:"],
+        stream=True
+    ):
+        token = chunk['choices'][0]['delta'].get('content', '')
+        if token:
+            parts.append(token)
+            if on_token is not None:
+                on_token("".join(parts))
+    return "".join(parts)
+
+
 class SQLGenerator:
     # Configuration for database connection, loaded from environment variables
     DB_CONFIG = {
@@ -24,27 +153,69 @@ class SQLGenerator:
         "database": os.getenv('DB_NAME', 'book_inventory')
     }
 
-    def __init__(self, api_key):
+    # Reuse the SQL of semantically equivalent earlier questions (opt-in)
+    SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+
+    # Minimum cosine similarity for reusing the SQL of a previously asked question
+    SEMANTIC_CACHE_THRESHOLD = 0.95
+
+    # Maximum number of questions kept in the semantic cache; oldest are evicted first
+    SEMANTIC_CACHE_MAX_ENTRIES = 500
+
+    # Maximum number of prompts whose validated SQL is kept in the exact cache,
+    # and how long each entry stays valid (seconds)
+    EXACT_CACHE_MAX_ENTRIES = 256
+    EXACT_CACHE_TTL = 3600
+
+    # Number of few-shot examples included in each prompt
+    NUM_EXAMPLES = 2
+
+    def __init__(self, api_key, example_matrix=None):
         """
         Initialize the SQLGenerator class.
         - Set up the OpenAI API key for GPT interaction.
-        - Initialize embeddings and example selector for semantic similarity.
-        - Create a prompt template for question-to-SQL transformation.
+        - Initialize embeddings and the few-shot example matrix for semantic similarity.
+        A prebuilt example matrix can be passed in when the caller runs the
+        initialization stages itself (e.g. to report progress).
         """
         self.api_key = api_key
         openai.api_key = self.api_key
-        self.example_selector = self.initialize_embeddings_and_selector()
-        self.prompt = self.create_prompt_template()
+        self._semantic_cache = None
+        self._semantic_cache_ids = deque()
+        self._semantic_cache_lock = threading.Lock()
+        self._exact_cache = OrderedDict()
+        self._exact_cache_lock = threading.Lock()
+        self.embeddings = self._load_embeddings()
+        # With only a handful of few-shot examples, a dense matrix product replaces a vector store
+        if example_matrix is None:
+            example_matrix = self._build_example_matrix(self.embeddings)
+        self.example_matrix = example_matrix
 
-    def initialize_embeddings_and_selector(self):
+    @staticmethod
+    def _load_embeddings():
         """
-        Initialize embeddings and the semantic similarity-based example selector.
-        - Uses Hugging Face embeddings to represent the few-shot examples.
-        - Builds a FAISS vector store to store the embeddings for similarity-based selection.
+        Load the quantized ONNX model used for embedding generation.
         """
         try:
-            # Load Hugging Face model for embedding generation
-            embeddings = HuggingFaceEmbeddings(model_name='sentence-transformers/all-MiniLM-L6-v2')
+            return load_embedding_model()
+        except Exception as e:
+            raise Exception(f"Error loading embeddings: {str(e)}")
+
+    @staticmethod
+    def _build_example_matrix(embeddings):
+        """
+        Build the L2-normalized embedding matrix of the few-shot examples.
+        - Loads the persisted matrix if one exists for the current few-shot examples.
+        - Otherwise embeds the examples and saves the matrix for the next start.
+        """
+        try:
+            if os.path.isfile(FEW_SHOTS_MATRIX_PATH):
+                try:
+                    example_matrix = np.load(FEW_SHOTS_MATRIX_PATH)
+                    if example_matrix.shape[0] == len(few_shots):
+                        return example_matrix
+                except (OSError, ValueError):
+                    pass  # Unreadable cache file; re-embed and overwrite it below
 
             # Prepare text data for the few-shot examples
             texts = [
@@ -52,66 +223,148 @@ class SQLGenerator:
                 for ex in few_shots
             ]
 
-            # Create a FAISS vector store for example selection
-            vectorstore = FAISS.from_texts(texts, embeddings, metadatas=few_shots)
+            example_matrix = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+            example_matrix /= np.linalg.norm(example_matrix, axis=1, keepdims=True)
 
-            # Initialize example selector using the vector store
-            return SemanticSimilarityExampleSelector(
-                vectorstore=vectorstore,
-                k=2  # Select the top 2 most similar examples
+            # Write to a temporary file and move it into place, so a crash or a
+            # concurrent start never leaves a half-written matrix behind
+            os.makedirs(os.path.dirname(FEW_SHOTS_MATRIX_PATH), exist_ok=True)
+            tmp_path = f"{FEW_SHOTS_MATRIX_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, example_matrix)
+            os.replace(tmp_path, FEW_SHOTS_MATRIX_PATH)
+            return example_matrix
+        except Exception as e:
+            raise Exception(f"Error embedding few-shot examples: {str(e)}")
+
+    def _embed_question(self, question):
+        """
+        Embed a question into an L2-normalized vector.
+        """
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def select_examples(self, question_vector):
+        """
+        Return the few-shot examples most similar to the question, best match first.
+        """
+        scores = self.example_matrix @ question_vector
+        top = np.argpartition(-scores, self.NUM_EXAMPLES)[:self.NUM_EXAMPLES]
+        return [few_shots[i] for i in top[np.argsort(-scores[top])]]
+
+    def _lookup_semantic_cache(self, question, question_vector):
+        """
+        Return the SQL of a previously answered question that is semantically
+        equivalent to this one, or None if nothing is close enough.
+        - Only questions with the same quoted and numeric literals can match.
+        """
+        with self._semantic_cache_lock:
+            if self._semantic_cache is None:
+                return None
+            matches = self._semantic_cache.similarity_search_with_score_by_vector(
+                question_vector.tolist(), k=1
             )
 
-        except Exception as e:
-            raise Exception(f"Error initializing embeddings: {str(e)}")
+        if not matches or matches[0][1] < self.SEMANTIC_CACHE_THRESHOLD:
+            return None
+        metadata = matches[0][0].metadata
+        if metadata['literals'] != _LITERAL_RE.findall(question):
+            return None
+        return metadata['SQLQuery']
+
+    def _store_semantic_cache(self, question, question_vector, query):
+        """
+        Remember the SQL generated for a question for later semantic cache hits,
+        evicting the oldest entry once SEMANTIC_CACHE_MAX_ENTRIES is reached.
+        """
+        text_embeddings = [(question, question_vector.tolist())]
+        metadatas = [{"SQLQuery": query, "literals": _LITERAL_RE.findall(question)}]
+        ids = [str(uuid.uuid4())]
+        with self._semantic_cache_lock:
+            if self._semantic_cache is None:
+                from langchain_community.vectorstores import FAISS
+                from langchain_community.vectorstores.utils import DistanceStrategy
+
+                # Inner product on normalized embeddings is cosine similarity
+                self._semantic_cache = FAISS.from_embeddings(
+                    text_embeddings,
+                    self.embeddings,
+                    metadatas=metadatas,
+                    ids=ids,
+                    distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+                )
+            else:
+                if len(self._semantic_cache_ids) >= self.SEMANTIC_CACHE_MAX_ENTRIES:
+                    self._semantic_cache.delete([self._semantic_cache_ids.popleft()])
+                self._semantic_cache.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+            self._semantic_cache_ids.extend(ids)
 
-    def create_prompt_template(self):
+    def _lookup_exact_cache(self, prompt):
         """
-        Create a prompt template for transforming natural language questions into SQL queries.
-        - Uses FewShotPromptTemplate for including examples dynamically based on similarity.
+        Return the validated SQL previously generated for an identical prompt,
+        or None if there is none or it has expired.
         """
-        # Template for formatting individual examples
-        example_prompt = PromptTemplate(
-            input_variables=["Question", "SQLQuery"],
-            template="Question: {Question}\nSQL: {SQLQuery}"
-        )
+        with self._exact_cache_lock:
+            entry = self._exact_cache.get(prompt)
+            if entry is None:
+                return None
+            query, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._exact_cache[prompt]
+                return None
+            self._exact_cache.move_to_end(prompt)
+            return query
 
-        # Define the complete prompt structure with prefix, examples, and suffix
-        return FewShotPromptTemplate(
-            example_selector=self.example_selector,
-            example_prompt=example_prompt,
-            prefix="""Convert the following question about book inventory into a SQL query.
-    Table: books (book_id, title, author_id, genre, price, stock_quantity)""",
-            suffix="\nQuestion: {question}\nSQL:",
-            input_variables=["question"],
-            example_separator="\n\n"
-        )
+    def _store_exact_cache(self, prompt, query):
+        """
+        Remember the validated SQL for a prompt, evicting the least recently used
+        entry once EXACT_CACHE_MAX_ENTRIES is reached.
+        """
+        with self._exact_cache_lock:
+            self._exact_cache[prompt] = (query, time.monotonic() + self.EXACT_CACHE_TTL)
+            self._exact_cache.move_to_end(prompt)
+            if len(self._exact_cache) > self.EXACT_CACHE_MAX_ENTRIES:
+                self._exact_cache.popitem(last=False)
 
-    def generate_sql(self, question):
+    def generate_sql(self, question, on_token=None):
         """
         Generate a SQL query from a natural language question using GPT-3.5-turbo.
-        - Formats the prompt with the input question.
-        - Sends the prompt to OpenAI API for SQL generation.
-        - Cleans and validates the generated SQL query.
+        - Reuses the SQL of a semantically equivalent earlier question if the
+          semantic cache is enabled.
+        - Formats the prompt with the selected examples and the input question.
+        - Reuses the validated SQL of an identical earlier prompt, otherwise streams
+          the response from OpenAI API, passing partial text to on_token.
+        - Cleans the generated SQL query and validates it with sqlglot.
         """
         try:
-            # Format the prompt with the input question
-            prompt = self.prompt.format(question=question)
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
+            # Embed the question once for both the cache probe and example selection
+            question_vector = self._embed_question(question)
+
+            if self.SEMANTIC_CACHE_ENABLED:
+                cached_query = self._lookup_semantic_cache(question, question_vector)
+                if cached_query is not None:
+                    return cached_query
+
+            # Format the prompt with the most similar examples and the input question
+            examples = self.select_examples(question_vector)
+            prompt = format_prompt(examples, question)
+
+            cached_query = self._lookup_exact_cache(prompt)
+            if cached_query is not None:
+                return cached_query
 
             # Extract and clean the generated SQL query
-            clean_response = response['choices'][0]['message']['content'].strip()
-            clean_response = clean_response.replace("SQL Query:[/INST]", "").replace("SQL Query:", "").strip()
+            clean_response = _RESPONSE_NOISE_RE.sub("", _stream_openai(prompt, on_token))
 
             # Ensure the response contains a valid SQL SELECT query
-            if 'SELECT' in clean_response:
-                query = [line.strip() for line in clean_response.split('\n') if 'SELECT' in line][0]
+            match = _SELECT_RE.search(clean_response)
+            if match:
+                query = match.group(0).strip()
                 query = query.replace('\_', '_')  # Remove escape characters
+                query = validate_sql(query)
+                self._store_exact_cache(prompt, query)
+                if self.SEMANTIC_CACHE_ENABLED:
+                    self._store_semantic_cache(question, question_vector, query)
                 return query
             else:
                 raise Exception("No valid SQL query generated")
@@ -122,28 +375,71 @@ class SQLGenerator:
     def execute_sql_query(self, query):
         """
         Execute the generated SQL query against the MySQL database.
-        - Connects to the database using the provided configuration.
-        - Executes the query and fetches results.
+        - Borrows a connection from the shared connection pool.
+        - Executes the query and reads the results with pandas.
         - Returns results as a Pandas DataFrame for easy handling.
         """
+        from mysql.connector import Error
+
+        connection = None
         try:
-            # Connect to the MySQL database
-            connection = mysql.connector.connect(**self.DB_CONFIG)
+            # Borrow a pooled connection to the MySQL database
+            connection = get_mysql_connection()
             if connection.is_connected():
-                cursor = connection.cursor()
-                cursor.execute(query)
-                results = cursor.fetchall()
-
-                # If the query has a result set, return it as a DataFrame
-                if cursor.description:
-                    columns = [desc[0] for desc in cursor.description]
-                    return pd.DataFrame(results, columns=columns)
-                return pd.DataFrame(results)  # Empty DataFrame for no result set
+                # Read the result set straight into a pyarrow-backed DataFrame in
+                # one pass, so every column gets a single consistent Arrow dtype.
+                # pandas warns for DB-API connections other than sqlite3, but its
+                # generic cursor path works for mysql.connector and keeps the pool.
+                with warnings.catch_warnings():
+                    warnings.filterwarnings(
+                        "ignore",
+                        message="pandas only supports SQLAlchemy connectable",
+                        category=UserWarning
+                    )
+                    return pd.read_sql_query(query, connection, dtype_backend="pyarrow")
 
-        except Error as e:
+        except (Error, pd.errors.DatabaseError) as e:
             raise Exception(f"Database Error: {e}")
         finally:
-            # Ensure the database connection is closed
-            if 'connection' in locals() and connection.is_connected():
-                cursor.close()
-                connection.close()
+            # Always hand the connection back, even if it dropped mid-query;
+            # the pool reconnects stale connections when they are next borrowed
+            if connection is not None:
+                try:
+                    connection.close()
+                except Error:
+                    pass
+
+
+def get_mysql_connection():
+    """
+    Borrow a connection from the shared pool.
+    Falls back to a dedicated connection when all POOL_SIZE pooled connections
+    are in use, so concurrent sessions beyond the pool size still get served.
+    """
+    import mysql.connector
+    from mysql.connector.errors import PoolError
+
+    try:
+        return get_mysql_pool().get_connection()
+    except PoolError:
+        return mysql.connector.connect(**SQLGenerator.DB_CONFIG)
+
+
+@st.cache_resource(show_spinner=False)
+def get_mysql_pool():
+    """
+    Create the MySQL connection pool once per process.
+    Closing a pooled connection returns it to the pool, so queries only pay
+    for execution instead of a fresh TCP and auth handshake.
+    """
+    import mysql.connector.pooling
+
+    return mysql.connector.pooling.MySQLConnectionPool(
+        pool_name="books",
+        pool_size=POOL_SIZE,
+        **SQLGenerator.DB_CONFIG
+    )
+
+
+if __name__ == "__main__":
+    print(f"Prompt tokens: {check_prompt_budget(SQLGenerator.NUM_EXAMPLES)}/{PROMPT_TOKEN_BUDGET}")
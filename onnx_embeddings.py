@@ -0,0 +1,94 @@
+import os
+import shutil
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from transformers import AutoTokenizer
+
+
+class QuantizedOnnxEmbeddings(Embeddings):
+    """
+    Sentence embeddings computed with an int8-quantized ONNX export of a
+    sentence-transformers model, run on ONNX Runtime's CPU provider.
+    Drop-in replacement for HuggingFaceEmbeddings (mean pooling + L2 normalization).
+    """
+    EXPORTED_FILE_NAME = "model.onnx"
+    QUANTIZED_FILE_NAME = "model_quantized.onnx"
+    PROVIDER = "CPUExecutionProvider"
+
+    def __init__(self, model_name, cache_dir, batch_size=16):
+        """
+        Load the quantized model from cache_dir, exporting and quantizing it first if missing.
+        Documents are encoded batch_size texts per forward pass.
+        """
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+
+        if not os.path.isfile(os.path.join(cache_dir, self.QUANTIZED_FILE_NAME)):
+            self._export_and_quantize()
+
+        self.tokenizer = AutoTokenizer.from_pretrained(cache_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            cache_dir,
+            file_name=self.QUANTIZED_FILE_NAME,
+            provider=self.PROVIDER
+        )
+
+    def _export_and_quantize(self):
+        """
+        Export the model to ONNX and apply dynamic int8 weight quantization.
+        Works in a per-process directory and moves the files into cache_dir with
+        the quantized model last, since its presence marks the cache as complete.
+        """
+        work_dir = f"{self.cache_dir}.{os.getpid()}.tmp"
+        model = ORTModelForFeatureExtraction.from_pretrained(
+            self.model_name,
+            export=True,
+            provider=self.PROVIDER
+        )
+        model.save_pretrained(work_dir)
+        AutoTokenizer.from_pretrained(self.model_name).save_pretrained(work_dir)
+
+        quantize_dynamic(
+            os.path.join(work_dir, self.EXPORTED_FILE_NAME),
+            os.path.join(work_dir, self.QUANTIZED_FILE_NAME),
+            weight_type=QuantType.QInt8
+        )
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name in sorted(os.listdir(work_dir), key=lambda n: n == self.QUANTIZED_FILE_NAME):
+            os.replace(os.path.join(work_dir, name), os.path.join(self.cache_dir, name))
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _encode(self, texts):
+        """
+        Encode texts into mean-pooled, L2-normalized embeddings.
+        """
+        inputs = self.tokenizer(texts, padding=True, truncation=True, return_tensors="np")
+        token_embeddings = self.model(**inputs).last_hidden_state
+
+        # Mean pooling over non-padding tokens
+        mask = inputs["attention_mask"][..., np.newaxis].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+    def embed_documents(self, texts):
+        """
+        Embed a list of documents, one batched forward pass per batch_size texts.
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        batches = [
+            self._encode(texts[start:start + self.batch_size])
+            for start in range(0, len(texts), self.batch_size)
+        ]
+        return np.concatenate(batches).tolist()
+
+    def embed_query(self, text):
+        """
+        Embed a single query.
+        """
+        return self._encode([text])[0].tolist()